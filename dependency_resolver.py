@@ -1,136 +1,397 @@
+import atexit
+import queue
+import re
+import threading
 import pyodbc
-from typing import List, Dict, Any, Set
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from typing import List, Dict, Any, Callable, Iterator
 
+_pools = {}
+_pools_lock = threading.Lock()
 
-def get_connection(config: Dict[str, str]) -> pyodbc.Connection:
+# Resolver of every open pooled connection; entries are dropped when their pool is closed.
+_pooled_resolvers = {}
+
+# SQL Server accepts at most 2100 parameters per statement.
+_MAX_BATCH_PARAMS = 2000
+
+# Dependency definitions are only context for the prompt; they are truncated server-side.
+_DEFINITION_SNIPPET_LENGTH = 500
+
+_CONN_TEMPLATE = (
+    "DRIVER={{{driver}}};"
+    "SERVER={server},{port};"
+    "DATABASE={database};"
+    "UID={user};"
+    "PWD={password};"
+    "TrustServerCertificate={trust_flag};"
+)
+
+
+def _connection_string(config: Dict[str, str]) -> str:
     trust_flag = "yes" if config.get("trust_server_certificate", False) else "no"
-    conn_str = (
-        f"DRIVER={{{config['driver']}}};"
-        f"SERVER={config['server']},{config['port']};"
-        f"DATABASE={config['database']};"
-        f"UID={config['user']};"
-        f"PWD={config['password']};"
-        f"TrustServerCertificate={trust_flag};"
+    return _CONN_TEMPLATE.format(
+        driver=config['driver'],
+        server=config['server'],
+        port=config['port'],
+        database=config['database'],
+        user=config['user'],
+        password=config['password'],
+        trust_flag=trust_flag,
     )
-    return pyodbc.connect(conn_str)
 
 
-def fetch_proc_definition(conn: pyodbc.Connection, proc_name: str, schema: str = 'dbo') -> str:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT m.definition
-        FROM sys.sql_modules m
-        JOIN sys.objects o ON m.object_id = o.object_id
-        JOIN sys.schemas s ON o.schema_id = s.schema_id
-        WHERE o.type = 'P' AND o.name = ? AND s.name = ?
-    """, proc_name, schema)
-    row = cursor.fetchone()
-    return row.definition if row else ""
+def get_connection(config: Dict[str, str]) -> pyodbc.Connection:
+    return pyodbc.connect(_connection_string(config))
+
+
+class ConnectionPool:
+    # pyodbc connections must not run statements concurrently, so every caller borrows its own
+    # connection from the pool for as long as it uses it.
+    def __init__(self, config: Dict[str, str], size: int = 2):
+        self._connections = queue.Queue()
+        for conn in self._open(_connection_string(config), size):
+            _pooled_resolvers[conn] = Resolver(conn)
+            self._connections.put(conn)
+
+    @staticmethod
+    def _open(conn_str: str, size: int) -> List[pyodbc.Connection]:
+        if size <= 1:
+            return [pyodbc.connect(conn_str) for _ in range(size)]
+        # Open the connections concurrently (pyodbc releases the GIL in connect), so warming up
+        # the pool costs about one login handshake instead of `size` sequential ones. All of them
+        # must succeed; otherwise the ones that did open are closed before the error propagates.
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            futures = [executor.submit(pyodbc.connect, conn_str) for _ in range(size)]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        connections = [future.result() for future in futures if future.exception() is None]
+        if errors:
+            for conn in connections:
+                conn.close()
+            raise errors[0]
+        return connections
+
+    def acquire(self) -> pyodbc.Connection:
+        return self._connections.get()
+
+    def release(self, conn: pyodbc.Connection):
+        self._connections.put(conn)
+
+    @contextmanager
+    def connection(self) -> Iterator[pyodbc.Connection]:
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        while not self._connections.empty():
+            conn = self._connections.get_nowait()
+            _pooled_resolvers.pop(conn, None)
+            conn.close()
+
+
+def get_pool(config: Dict[str, Any], size: int = 2) -> ConnectionPool:
+    # One pool per database configuration for the lifetime of the process, so repeated runs
+    # (e.g. several procedures refactored from one script) reuse already authenticated connections.
+    key = (tuple(sorted(config.items())), size)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(config, size)
+            atexit.register(pool.close)
+    return pool
+
+
+_PROC_SQL = """
+    SELECT m.definition
+    FROM sys.sql_modules m
+    JOIN sys.objects o ON m.object_id = o.object_id
+    JOIN sys.schemas s ON o.schema_id = s.schema_id
+    WHERE o.type = 'P' AND o.name = ? AND s.name = ?
+"""
+
+_FUNCTION_SQL = """
+    SELECT m.definition
+    FROM sys.objects o
+    JOIN sys.sql_modules m ON o.object_id = m.object_id
+    JOIN sys.schemas s ON o.schema_id = s.schema_id
+    WHERE o.type IN ('FN', 'IF', 'TF') AND o.name = ? AND s.name = ?
+"""
+
+# Variants that truncate the definition on the server, so only max_len characters cross the wire.
+_PROC_SNIPPET_SQL = _PROC_SQL.replace("SELECT m.definition", "SELECT left(m.definition, ?) AS definition")
+_FUNCTION_SNIPPET_SQL = _FUNCTION_SQL.replace("SELECT m.definition", "SELECT left(m.definition, ?) AS definition")
+
+_TABLE_TYPE_COLUMNS_SQL = """
+    SELECT c.name AS column_name, ty.name AS data_type, c.max_length, c.is_nullable
+    FROM sys.table_types t
+    JOIN sys.columns c ON t.type_table_object_id = c.object_id
+    JOIN sys.types ty ON c.user_type_id = ty.user_type_id
+    JOIN sys.schemas s ON t.schema_id = s.schema_id
+    WHERE t.name = ? AND s.name = ?
+"""
+
+_SCALAR_UDT_SQL = """
+    SELECT t.name, t.system_type_id, bt.name AS base_type, t.max_length
+    FROM sys.types t
+    LEFT JOIN sys.types bt ON t.system_type_id = bt.user_type_id
+    WHERE t.is_user_defined = 1 AND t.name = ?
+"""
+
+
+def _memoized(method: Callable[..., Any]) -> Callable[..., Any]:
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        key = (method.__name__, args, tuple(sorted(kwargs.items())))
+        if key not in self._cache:
+            self._cache[key] = method(self, *args, **kwargs)
+        return self._cache[key]
+    return wrapper
+
+
+class Resolver:
+    # One long-lived cursor per statement shape: re-executing the same SQL text on the same cursor
+    # lets the driver reuse the prepared statement instead of preparing it again on every lookup.
+    # Every method drains its result set, as the connection cannot serve another cursor while
+    # results are pending. Lookups are memoized for the life of the Resolver; cached results are
+    # shared and must not be mutated by callers.
+    def __init__(self, conn: pyodbc.Connection):
+        self._conn = conn
+        self._cache = {}
+        self._cursors = {}
+
+    def _cursor(self, shape: str) -> pyodbc.Cursor:
+        # Cursors are opened on first use, so a one-off lookup allocates a single statement handle.
+        cursor = self._cursors.get(shape)
+        if cursor is None:
+            cursor = self._cursors[shape] = self._conn.cursor()
+        return cursor
+
+    @_memoized
+    def proc_definition(self, proc_name: str, schema: str = 'dbo', max_len: int = None) -> str:
+        if max_len is None:
+            rows = self._cursor("proc").execute(_PROC_SQL, proc_name, schema).fetchall()
+        else:
+            rows = self._cursor("proc_snippet").execute(_PROC_SNIPPET_SQL, max_len, proc_name, schema).fetchall()
+        return rows[0].definition if rows else ""
+
+    @_memoized
+    def function_definition(self, func_name: str, schema: str = 'dbo', max_len: int = None) -> str:
+        if max_len is None:
+            rows = self._cursor("function").execute(_FUNCTION_SQL, func_name, schema).fetchall()
+        else:
+            rows = self._cursor("function_snippet").execute(_FUNCTION_SNIPPET_SQL, max_len, func_name,
+                                                    schema).fetchall()
+        return rows[0].definition if rows else ""
+
+    @_memoized
+    def table_columns(self, table_name: str, schema: str = 'dbo') -> List[Dict[str, Any]]:
+        # SQLColumns catalog call instead of the INFORMATION_SCHEMA view, remapped to the same keys.
+        # Its arguments are search patterns (`_` is a wildcard), hence the exact name checks. Unlike
+        # INFORMATION_SCHEMA, DATA_TYPE reports alias types by their own name, not their base type.
+        columns = []
+        for row in self._cursor("columns").columns(table=table_name, schema=schema).fetchall():
+            if row.table_name.lower() != table_name.lower() or row.table_schem.lower() != schema.lower():
+                continue
+            if row.char_octet_length is None:
+                max_length = None
+            else:
+                # (max) types report a size of 0; INFORMATION_SCHEMA reports them as -1.
+                max_length = row.column_size or -1
+            columns.append({
+                "COLUMN_NAME": row.column_name,
+                "DATA_TYPE": row.type_name.replace(" identity", ""),
+                "CHARACTER_MAXIMUM_LENGTH": max_length,
+                "IS_NULLABLE": row.is_nullable
+            })
+        return columns
+
+    @_memoized
+    def table_type_columns(self, type_name: str, schema: str = 'dbo') -> List[Dict[str, Any]]:
+        cursor = self._cursor("table_type").execute(_TABLE_TYPE_COLUMNS_SQL, type_name, schema)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @_memoized
+    def scalar_udt_info(self, type_name: str) -> Dict[str, Any]:
+        cursor = self._cursor("udt").execute(_SCALAR_UDT_SQL, type_name)
+        rows = cursor.fetchall()
+        return dict(zip([column[0] for column in cursor.description], rows[0])) if rows else {}
+
+
+def _resolver(conn: pyodbc.Connection) -> Resolver:
+    # Pooled connections share one Resolver (cursors and memoized lookups) until their pool is
+    # closed; any other connection gets a short-lived one, so nothing outlives the caller's handle.
+    resolver = _pooled_resolvers.get(conn)
+    return resolver if resolver is not None else Resolver(conn)
+
+
+def fetch_proc_definition(conn: pyodbc.Connection, proc_name: str, schema: str = 'dbo',
+                          max_len: int = None) -> str:
+    return _resolver(conn).proc_definition(proc_name, schema, max_len)
 
 
 def fetch_table_columns(conn: pyodbc.Connection, table_name: str, schema: str = 'dbo') -> List[Dict[str, Any]]:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE
-        FROM INFORMATION_SCHEMA.COLUMNS
-        WHERE TABLE_NAME = ? AND TABLE_SCHEMA = ?
-    """, table_name, schema)
-    return [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
+    return _resolver(conn).table_columns(table_name, schema)
 
 
-def fetch_function_definition(conn: pyodbc.Connection, func_name: str, schema: str = 'dbo') -> str:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT m.definition
-        FROM sys.objects o
-        JOIN sys.sql_modules m ON o.object_id = m.object_id
-        JOIN sys.schemas s ON o.schema_id = s.schema_id
-        WHERE o.type IN ('FN', 'IF', 'TF') AND o.name = ? AND s.name = ?
-    """, func_name, schema)
-    row = cursor.fetchone()
-    return row.definition if row else ""
+def fetch_function_definition(conn: pyodbc.Connection, func_name: str, schema: str = 'dbo',
+                              max_len: int = None) -> str:
+    return _resolver(conn).function_definition(func_name, schema, max_len)
 
 
 def fetch_table_type_columns(conn: pyodbc.Connection, type_name: str, schema: str = 'dbo') -> List[Dict[str, Any]]:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT c.name AS column_name, ty.name AS data_type, c.max_length, c.is_nullable
-        FROM sys.table_types t
-        JOIN sys.columns c ON t.type_table_object_id = c.object_id
-        JOIN sys.types ty ON c.user_type_id = ty.user_type_id
-        JOIN sys.schemas s ON t.schema_id = s.schema_id
-        WHERE t.name = ? AND s.name = ?
-    """, type_name, schema)
-    return [dict(zip([column[0] for column in cursor.description], row)) for row in cursor.fetchall()]
+    return _resolver(conn).table_type_columns(type_name, schema)
 
 
 def fetch_scalar_udt_info(conn: pyodbc.Connection, type_name: str) -> Dict[str, Any]:
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT t.name, t.system_type_id, bt.name AS base_type, t.max_length
-        FROM sys.types t
-        LEFT JOIN sys.types bt ON t.system_type_id = bt.user_type_id
-        WHERE t.is_user_defined = 1 AND t.name = ?
-    """, type_name)
-    row = cursor.fetchone()
-    return dict(zip([column[0] for column in cursor.description], row)) if row else {}
+    return _resolver(conn).scalar_udt_info(type_name)
+
 
+# Sources of the ids referenced by the callers selected with a `caller`/`s` filter. The DMV binds each
+# caller's body when queried and returns its references in one table-valued call; it raises when a
+# caller no longer binds (e.g. it references a dropped column), so the catalog view is the fallback.
+# Only class 1 (object or column) references carry an object_id; types and XML schema collections
+# would put their own ids into the IN list.
+_REFERENCED_ENTITIES_SOURCE = """
+            SELECT r.referenced_id
+            FROM sys.objects caller
+            JOIN sys.schemas s ON caller.schema_id = s.schema_id
+            CROSS APPLY sys.dm_sql_referenced_entities(quotename(s.name) + '.' + quotename(caller.name), 'OBJECT') r
+            WHERE {caller_filter} AND r.referenced_class = 1
+"""
 
-def collect_dependencies_via_sys_views(conn: pyodbc.Connection, proc_name: str, schema: str = 'dbo', depth: int = 1,
-                                       visited: Set[str] = None) -> Dict[str, Any]:
-    if visited is None:
-        visited = set()
+_EXPRESSION_DEPENDENCIES_SOURCE = """
+            SELECT dep.referenced_id
+            FROM sys.sql_expression_dependencies dep
+            JOIN sys.objects caller ON dep.referencing_id = caller.object_id
+            JOIN sys.schemas s ON caller.schema_id = s.schema_id
+            WHERE {caller_filter} AND dep.referenced_class = 1
+"""
 
+# Native errors raised when the DMV cannot bind a caller: invalid column (207) or object (208) name,
+# unbound multi-part identifier (4104), and the DMV's own 2020 that accompanies them.
+_BINDING_ERRORS = {207, 208, 2020, 4104}
+_NATIVE_ERROR_MARKER = re.compile(r"\((\d+)\) \(SQL\w+\)")
+
+
+def _query_referenced_objects(cursor: pyodbc.Cursor, source: str, params: List[Any]) -> List[pyodbc.Row]:
+    # Objects whose ids are returned by `source`, with their columns (tables/views) or a truncated
+    # definition (functions/procedures). The IN subquery returns each object once even when several
+    # callers reference it.
+    cursor.execute(f"""
+        SELECT
+            o.object_id,
+            rs.name AS ref_schema,
+            o.name AS ref_name,
+            o.type_desc,
+            c.name AS column_name,
+            isnull(type_name(c.system_type_id), ty.name) AS data_type,
+            columnproperty(c.object_id, c.name, 'charmaxlen') AS max_length,
+            CASE c.is_nullable WHEN 1 THEN 'YES' WHEN 0 THEN 'NO' END AS is_nullable,
+            left(m.definition, ?) AS definition_snippet
+        FROM sys.objects o
+        JOIN sys.schemas rs ON o.schema_id = rs.schema_id
+        LEFT JOIN sys.sql_modules m ON m.object_id = o.object_id AND o.type IN ('FN', 'IF', 'TF', 'P')
+        LEFT JOIN sys.columns c ON c.object_id = o.object_id AND o.type IN ('U', 'V')
+        LEFT JOIN sys.types ty ON c.user_type_id = ty.user_type_id
+        WHERE o.is_ms_shipped = 0 AND o.object_id IN ({source})
+        ORDER BY o.object_id, c.column_id
+    """, _DEFINITION_SNIPPET_LENGTH, *params)
+    return cursor.fetchall()
+
+
+def _is_binding_error(error: pyodbc.Error) -> bool:
+    # pyodbc ends the primary driver message with "(<native error>) (SQLExecDirectW)". Only that
+    # marker counts: object names and message text can contain parenthesised numbers of their own.
+    match = _NATIVE_ERROR_MARKER.search(str(error.args[-1])) if error.args else None
+    return match is not None and int(match.group(1)) in _BINDING_ERRORS
+
+
+def _fetch_referenced_objects(cursor: pyodbc.Cursor, caller_filter: str, params: List[Any]) -> List[pyodbc.Row]:
+    try:
+        return _query_referenced_objects(cursor, _REFERENCED_ENTITIES_SOURCE.format(caller_filter=caller_filter),
+                                         params)
+    except pyodbc.Error as e:
+        if not _is_binding_error(e):
+            raise
+        return _query_referenced_objects(cursor, _EXPRESSION_DEPENDENCIES_SOURCE.format(caller_filter=caller_filter),
+                                         params)
+
+
+def _add_dependency(context: Dict[str, Any], row: pyodbc.Row) -> bool:
+    # Returns True when the object is a module whose own dependencies should be resolved.
+    name = row.ref_name
+    obj_type = row.type_desc.upper()
+    if obj_type in ("USER_TABLE", "VIEW"):
+        entry = context.setdefault(name, {
+            "type": "table" if obj_type == "USER_TABLE" else "view",
+            "columns": []
+        })
+        if row.column_name is not None:
+            entry["columns"].append({
+                "COLUMN_NAME": row.column_name,
+                "DATA_TYPE": row.data_type,
+                "CHARACTER_MAXIMUM_LENGTH": row.max_length,
+                "IS_NULLABLE": row.is_nullable
+            })
+    elif "FUNCTION" in obj_type:
+        context[name] = {
+            "type": "function",
+            "definition": row.definition_snippet or ""
+        }
+        return True
+    elif obj_type == "SQL_STORED_PROCEDURE":
+        context[name] = {
+            "type": "procedure",
+            "definition": row.definition_snippet or ""
+        }
+        return True
+    return False
+
+
+def collect_dependencies_via_sys_views(conn: pyodbc.Connection, proc_name: str, schema: str = 'dbo',
+                                       depth: int = 1) -> Dict[str, Any]:
     context = {}
-    key = f"{schema}.{proc_name}".lower()
-    if key in visited or depth < 0:
+    if depth < 0:
         return context
-    visited.add(key)
 
+    # Breadth-first walk: one query per level for the whole frontier, so the number of round-trips
+    # is bounded by depth and every object is expanded at most once.
+    visited = {f"{schema}.{proc_name}".lower()}
     cursor = conn.cursor()
-    cursor.execute("""
-        SELECT 
-            dep.referenced_entity_name,
-            coalesce(dep.referenced_schema_name, 'dbo') as referenced_schema_name,
-            obj.type_desc
-        FROM sys.sql_expression_dependencies dep
-        JOIN sys.objects obj ON dep.referenced_id = obj.object_id
-        JOIN sys.objects caller ON dep.referencing_id = caller.object_id
-        JOIN sys.schemas s ON caller.schema_id = s.schema_id
-        WHERE caller.name = ? AND s.name = ? AND obj.is_ms_shipped = 0
-    """, proc_name, schema)
-
-    for row in cursor.fetchall():
-        name, ref_schema, obj_type = row
-        obj_type = obj_type.upper()
-        ref_key = f"{ref_schema}.{name}".lower()
-        if ref_key in visited:
-            continue
+    rows = _fetch_referenced_objects(cursor, "caller.name = ? AND s.name = ?", [proc_name, schema])
 
-        try:
-            if obj_type in ("USER_TABLE", "VIEW"):
-                columns = fetch_table_columns(conn, name, ref_schema)
-                context[name] = {
-                    "type": "table" if obj_type == "USER_TABLE" else "view",
-                    "columns": columns
-                }
-            elif "FUNCTION" in obj_type:
-                definition = fetch_function_definition(conn, name, ref_schema)
-                context[name] = {
-                    "type": "function",
-                    "definition": definition[:500]
-                }
-                nested = collect_dependencies_via_sys_views(conn, name, ref_schema, depth - 1, visited)
-                context.update(nested)
-            elif obj_type == "SQL_STORED_PROCEDURE":
-                definition = fetch_proc_definition(conn, name, ref_schema)
-                context[name] = {
-                    "type": "procedure",
-                    "definition": definition[:500]
-                }
-                nested = collect_dependencies_via_sys_views(conn, name, ref_schema, depth - 1, visited)
-                context.update(nested)
-        except Exception as e:
-            context[name] = {"error": str(e)}
+    for level in range(depth + 1):
+        frontier = []
+        added = set()
+        for row in rows:
+            ref_key = f"{row.ref_schema}.{row.ref_name}".lower()
+            if ref_key not in added:
+                if ref_key in visited:
+                    continue
+                visited.add(ref_key)
+                added.add(ref_key)
+            if _add_dependency(context, row):
+                frontier.append(row.object_id)
+
+        if level == depth or not frontier:
+            break
+
+        # Each batch returns an object at most once, but an object referenced from two batches comes
+        # back in both; keep only the first copy so its columns are not appended twice.
+        rows = []
+        fetched = set()
+        for start in range(0, len(frontier), _MAX_BATCH_PARAMS):
+            batch = frontier[start:start + _MAX_BATCH_PARAMS]
+            batch_rows = _fetch_referenced_objects(
+                cursor, f"caller.object_id IN ({', '.join('?' * len(batch))})", batch
+            )
+            rows.extend(row for row in batch_rows if row.object_id not in fetched)
+            fetched.update(row.object_id for row in batch_rows)
 
     return context
@@ -1,13 +1,28 @@
 import argparse
+import atexit
 import json
+import os
 from pathlib import Path
 from dependency_resolver import (
-    get_connection,
+    get_pool,
     fetch_proc_definition,
     collect_dependencies_via_sys_views,
 )
+import orjson
 import tomli
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_audit_fds = {}
+
+# Keep-alive session shared by all API calls. Retry covers connection-level failures only: POST is
+# not in urllib3's default allowed_methods, so a request that reached the service is never resent.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8,
+                                       max_retries=Retry(total=3, backoff_factor=0.2)))
+# (connect, read) seconds; the read timeout leaves room for slow refactoring responses.
+_API_TIMEOUT = (5, 300)
 
 
 def load_config(path: str = "config/default_config.toml") -> dict:
@@ -15,13 +30,30 @@ def load_config(path: str = "config/default_config.toml") -> dict:
         return tomli.load(f)
 
 
+def _close_audit_fds():
+    for fd in _audit_fds.values():
+        os.close(fd)
+    _audit_fds.clear()
+
+
+atexit.register(_close_audit_fds)
+
+
 def log_audit(entry: dict, path: str):
-    with open(path, "a") as f:
-        f.write(json.dumps(entry) + "\n")
+    # Audit files stay open for the life of the process. O_APPEND plus a single gather-write keeps
+    # every record intact on disk without concatenating the payload and its newline first.
+    fd = _audit_fds.get(path)
+    if fd is None:
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+        fd = _audit_fds[path] = os.open(path, flags, 0o644)
+    payload = orjson.dumps(entry)
+    if hasattr(os, "writev"):
+        os.writev(fd, [payload, b"\n"])
+    else:
+        os.write(fd, payload + b"\n")
 
 
-def build_prompt(proc_name: str, sql_text: str, context: dict, user_notes: str = "") -> dict:
-    instruction = """Refactor and modernize the stored procedure below.
+_INSTRUCTION = """Refactor and modernize the stored procedure below.
 
 Use the provided metadata to ensure accuracy and correctness.
 
@@ -38,6 +70,10 @@ Use the provided metadata to ensure accuracy and correctness.
 - Avoid deprecated or outdated patterns
 - Preserve functional equivalence with original procedure
 """
+
+
+def build_prompt(proc_name: str, sql_text: str, context: dict, user_notes: str = "") -> dict:
+    instruction = _INSTRUCTION
     if user_notes:
         instruction += f"\n### Additional Notes:\n- {user_notes.strip()}"
 
@@ -49,12 +85,14 @@ Use the provided metadata to ensure accuracy and correctness.
     }
 
 
-def call_ai_refactor(api_key: str, endpoint: str, prompt: dict) -> str:
+def call_ai_refactor(api_key: str, endpoint: str, prompt: dict, body: bytes = None) -> str:
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
-    response = requests.post(endpoint, headers=headers, json=prompt)
+    if body is None:
+        body = orjson.dumps(prompt)
+    response = _session.post(endpoint, headers=headers, data=body, timeout=_API_TIMEOUT)
     response.raise_for_status()
     return response.json().get("refactored_sql", prompt["sql"]).strip()
 
@@ -73,17 +111,19 @@ def main():
     config = load_config(args.config)
 
     Path(args.audit_log).parent.mkdir(parents=True, exist_ok=True)
-    Path(config['defaults']['temp_output_dir']).mkdir(parents=True, exist_ok=True)
 
-    conn = get_connection(config['database'])
-    proc_sql = fetch_proc_definition(conn, args.proc_name, args.schema)
+    # Fetch the definition first so a missing procedure never pays for the dependency walk.
+    pool = get_pool(config['database'], size=1)
+    with pool.connection() as conn:
+        proc_sql = fetch_proc_definition(conn, args.proc_name, args.schema)
 
-    if not proc_sql:
-        print(f"Procedure {args.schema}.{args.proc_name} not found.")
-        return
+        if not proc_sql:
+            print(f"Procedure {args.schema}.{args.proc_name} not found.")
+            return
+
+        print("Analyzing dependencies...")
+        context = collect_dependencies_via_sys_views(conn, args.proc_name, args.schema, depth=args.depth)
 
-    print("Analyzing dependencies...")
-    context = collect_dependencies_via_sys_views(conn, args.proc_name, args.schema, depth=args.depth)
     prompt = build_prompt(args.proc_name, proc_sql, context, user_notes=args.user_notes)
 
     if args.dry_run:
@@ -96,21 +136,26 @@ def main():
         print(json.dumps(prompt, indent=2))
         return
 
+    # The prompt carries the whole dependency context; serialize it once and reuse the bytes for
+    # both the request body and the audit entry.
+    prompt_body = orjson.dumps(prompt)
+
     try:
         print("Calling AI refactoring service...")
         refactored_sql = call_ai_refactor(
             api_key=config['api']['key'],
             endpoint=config['api']['endpoint'],
-            prompt=prompt
+            prompt=prompt,
+            body=prompt_body
         )
         log_audit({
             "proc_name": args.proc_name,
-            "prompt": prompt,
+            "prompt": orjson.Fragment(prompt_body),
             "response": {"refactored_sql": refactored_sql}
         }, args.audit_log)
         print("\n✅ Refactoring complete:\n")
         print(refactored_sql)
-    except requests.HTTPError as e:
+    except requests.RequestException as e:
         print(f"❌ AI API request failed: {e}")
 
 
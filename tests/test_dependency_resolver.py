@@ -0,0 +1,386 @@
+import itertools
+from types import SimpleNamespace
+
+import pyodbc
+import pytest
+
+import dependency_resolver
+from dependency_resolver import (
+    ConnectionPool,
+    Resolver,
+    _add_dependency,
+    collect_dependencies_via_sys_views,
+    fetch_proc_definition,
+)
+
+
+def make_row(object_id, name, type_desc, schema="dbo", column_name=None, data_type=None, max_length=None,
+             is_nullable=None, definition_snippet=None):
+    return SimpleNamespace(
+        object_id=object_id,
+        ref_schema=schema,
+        ref_name=name,
+        type_desc=type_desc,
+        column_name=column_name,
+        data_type=data_type,
+        max_length=max_length,
+        is_nullable=is_nullable,
+        definition_snippet=definition_snippet,
+    )
+
+
+class FakeCursor:
+    # Mimics the per-level dependency query: the seed query is matched by name, frontier queries by
+    # caller object_id, and every referenced object is returned once per query, ordered by object_id.
+    def __init__(self, seed_rows, references):
+        self.seed_rows = seed_rows
+        self.references = references
+        self.executed = []
+        self.statements = []
+        self._rows = []
+
+    def execute(self, sql, *params):
+        self.executed.append(params)
+        self.statements.append(sql)
+        if "caller.name = ?" in sql:
+            self._rows = list(self.seed_rows)
+        else:
+            objects = {}
+            for caller_id in params[1:]:
+                for row in self.references.get(caller_id, []):
+                    objects.setdefault(row.object_id, []).append(row)
+            self._rows = [row for object_id in sorted(objects) for row in objects[object_id]]
+        return self
+
+    def fetchall(self):
+        return self._rows
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def cursor(self):
+        return self._cursor
+
+
+def table_rows(object_id, name, *columns):
+    return [make_row(object_id, name, "USER_TABLE", column_name=column, data_type="int", is_nullable="NO")
+            for column in columns]
+
+
+def test_add_dependency_groups_column_rows_per_table():
+    context = {}
+    rows = [
+        make_row(1, "Orders", "USER_TABLE", column_name="Id", data_type="int", is_nullable="NO"),
+        make_row(1, "Orders", "USER_TABLE", column_name="Note", data_type="nvarchar", max_length=-1,
+                 is_nullable="YES"),
+    ]
+
+    expanded = [_add_dependency(context, row) for row in rows]
+
+    assert expanded == [False, False]
+    assert context == {
+        "Orders": {
+            "type": "table",
+            "columns": [
+                {"COLUMN_NAME": "Id", "DATA_TYPE": "int", "CHARACTER_MAXIMUM_LENGTH": None, "IS_NULLABLE": "NO"},
+                {"COLUMN_NAME": "Note", "DATA_TYPE": "nvarchar", "CHARACTER_MAXIMUM_LENGTH": -1,
+                 "IS_NULLABLE": "YES"},
+            ]
+        }
+    }
+
+
+def test_add_dependency_keeps_view_without_columns():
+    context = {}
+
+    _add_dependency(context, make_row(2, "vOrders", "VIEW"))
+
+    assert context == {"vOrders": {"type": "view", "columns": []}}
+
+
+def test_add_dependency_marks_modules_for_expansion():
+    context = {}
+
+    assert _add_dependency(context, make_row(3, "fnTotal", "SQL_SCALAR_FUNCTION", definition_snippet="CREATE FUNCTION"))
+    assert _add_dependency(context, make_row(4, "uspAudit", "SQL_STORED_PROCEDURE"))
+    assert not _add_dependency(context, make_row(5, "seqIds", "SEQUENCE_OBJECT"))
+
+    assert context == {
+        "fnTotal": {"type": "function", "definition": "CREATE FUNCTION"},
+        "uspAudit": {"type": "procedure", "definition": ""},
+    }
+
+
+def test_collect_dependencies_negative_depth_issues_no_query():
+    cursor = FakeCursor([], {})
+
+    assert collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=-1) == {}
+    assert cursor.executed == []
+
+
+def test_collect_dependencies_depth_zero_does_not_expand_modules():
+    cursor = FakeCursor(
+        [make_row(10, "uspChild", "SQL_STORED_PROCEDURE", definition_snippet="CREATE PROCEDURE")],
+        {10: table_rows(1, "Orders", "Id")},
+    )
+
+    context = collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=0)
+
+    assert context == {"uspChild": {"type": "procedure", "definition": "CREATE PROCEDURE"}}
+    assert len(cursor.executed) == 1
+
+
+def test_collect_dependencies_expands_one_level_per_depth_and_skips_visited():
+    cursor = FakeCursor(
+        table_rows(1, "Orders", "Id") + [make_row(10, "uspChild", "SQL_STORED_PROCEDURE")],
+        {
+            10: table_rows(1, "Orders", "Id")
+            + table_rows(2, "Lines", "OrderId")
+            + [make_row(99, "uspMain", "SQL_STORED_PROCEDURE"), make_row(11, "uspGrandChild", "SQL_STORED_PROCEDURE")],
+            11: table_rows(3, "Audit", "Id"),
+        },
+    )
+
+    context = collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=1)
+
+    assert set(context) == {"Orders", "uspChild", "Lines", "uspGrandChild"}
+    assert context["Orders"]["columns"] == [
+        {"COLUMN_NAME": "Id", "DATA_TYPE": "int", "CHARACTER_MAXIMUM_LENGTH": None, "IS_NULLABLE": "NO"}
+    ]
+    assert cursor.executed == [
+        (dependency_resolver._DEFINITION_SNIPPET_LENGTH, "uspMain", "dbo"),
+        (dependency_resolver._DEFINITION_SNIPPET_LENGTH, 10),
+    ]
+
+
+def test_collect_dependencies_dedupes_objects_across_frontier_batches(monkeypatch):
+    monkeypatch.setattr(dependency_resolver, "_MAX_BATCH_PARAMS", 1)
+    shared = table_rows(1, "T", "a", "b") + [make_row(12, "uspShared", "SQL_STORED_PROCEDURE")]
+    cursor = FakeCursor(
+        [make_row(10, "uspLeft", "SQL_STORED_PROCEDURE"), make_row(11, "uspRight", "SQL_STORED_PROCEDURE")],
+        {10: shared, 11: shared, 12: table_rows(2, "U", "c")},
+    )
+
+    context = collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=2)
+
+    assert [column["COLUMN_NAME"] for column in context["T"]["columns"]] == ["a", "b"]
+    assert [column["COLUMN_NAME"] for column in context["U"]["columns"]] == ["c"]
+    assert cursor.executed[-1] == (dependency_resolver._DEFINITION_SNIPPET_LENGTH, 12)
+    assert len(cursor.executed) == 4
+
+
+class FakeCatalogCursor:
+    def __init__(self, rows):
+        self.rows = rows
+        self.calls = []
+
+    def columns(self, table=None, schema=None):
+        self.calls.append((table, schema))
+        return self
+
+    def fetchall(self):
+        return self.rows
+
+
+def catalog_row(schema, table, column, type_name, column_size, char_octet_length, is_nullable):
+    return SimpleNamespace(table_schem=schema, table_name=table, column_name=column, type_name=type_name,
+                           column_size=column_size, char_octet_length=char_octet_length, is_nullable=is_nullable)
+
+
+def test_table_columns_remaps_sqlcolumns_rows_to_information_schema_shape():
+    cursor = FakeCatalogCursor([
+        catalog_row("sales_eu", "Order_Items", "Id", "int identity", 10, None, "NO"),
+        catalog_row("sales_eu", "Order_Items", "Code", "varchar", 20, 20, "YES"),
+        catalog_row("sales_eu", "Order_Items", "Notes", "nvarchar", 0, 0, "YES"),
+        catalog_row("sales_eu", "OrderXItems", "Other", "int", 10, None, "NO"),
+        catalog_row("salesXeu", "Order_Items", "Archived", "bit", 1, None, "NO"),
+    ])
+
+    columns = Resolver(FakeConnection(cursor)).table_columns("Order_Items", "sales_eu")
+
+    assert cursor.calls == [("Order_Items", "sales_eu")]
+    assert columns == [
+        {"COLUMN_NAME": "Id", "DATA_TYPE": "int", "CHARACTER_MAXIMUM_LENGTH": None, "IS_NULLABLE": "NO"},
+        {"COLUMN_NAME": "Code", "DATA_TYPE": "varchar", "CHARACTER_MAXIMUM_LENGTH": 20, "IS_NULLABLE": "YES"},
+        {"COLUMN_NAME": "Notes", "DATA_TYPE": "nvarchar", "CHARACTER_MAXIMUM_LENGTH": -1, "IS_NULLABLE": "YES"},
+    ]
+
+
+class FakeDefinitionCursor:
+    def __init__(self, definition):
+        self.definition = definition
+        self.executed = []
+
+    def execute(self, sql, *params):
+        self.executed.append(params)
+        return self
+
+    def fetchall(self):
+        return [SimpleNamespace(definition=self.definition)]
+
+
+class FakePooledConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.closed = False
+
+    def cursor(self):
+        return self._cursor
+
+    def close(self):
+        self.closed = True
+
+
+POOL_CONFIG = {"driver": "ODBC Driver 18 for SQL Server", "server": "localhost", "port": 1433,
+               "database": "db", "user": "u", "password": "p"}
+
+
+def test_pooled_connection_memoizes_lookups_until_pool_is_closed(monkeypatch):
+    cursor = FakeDefinitionCursor("CREATE PROCEDURE uspMain AS SELECT 1")
+    conn = FakePooledConnection(cursor)
+    monkeypatch.setattr(dependency_resolver.pyodbc, "connect", lambda conn_str: conn)
+
+    pool = ConnectionPool(POOL_CONFIG, size=1)
+    with pool.connection() as pooled:
+        assert fetch_proc_definition(pooled, "uspMain") == cursor.definition
+        assert fetch_proc_definition(pooled, "uspMain") == cursor.definition
+    assert cursor.executed == [("uspMain", "dbo")]
+
+    pool.close()
+
+    assert conn.closed
+    assert conn not in dependency_resolver._pooled_resolvers
+
+
+def test_unpooled_connection_is_not_retained():
+    cursor = FakeDefinitionCursor("CREATE PROCEDURE uspMain AS SELECT 1")
+    conn = FakePooledConnection(cursor)
+
+    fetch_proc_definition(conn, "uspMain")
+    fetch_proc_definition(conn, "uspMain")
+
+    assert len(cursor.executed) == 2
+    assert conn not in dependency_resolver._pooled_resolvers
+
+
+class FailingDmvCursor(FakeCursor):
+    def __init__(self, seed_rows, error):
+        super().__init__(seed_rows, {})
+        self.error = error
+        self.sources = []
+
+    def execute(self, sql, *params):
+        uses_dmv = "dm_sql_referenced_entities" in sql
+        self.sources.append("dmv" if uses_dmv else "catalog")
+        if uses_dmv:
+            raise self.error
+        return super().execute(sql, *params)
+
+
+def test_collect_dependencies_falls_back_to_catalog_view_on_binding_error():
+    error = pyodbc.ProgrammingError(
+        "42S22", "[42S22] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]Invalid column name 'Gone'. (207) (SQLExecDirectW)"
+    )
+    cursor = FailingDmvCursor(table_rows(1, "Orders", "Id"), error)
+
+    context = collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=0)
+
+    assert list(context) == ["Orders"]
+    assert cursor.sources == ["dmv", "catalog"]
+
+
+def test_collect_dependencies_propagates_non_binding_errors():
+    error = pyodbc.ProgrammingError(
+        "42000", "[42000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]VIEW DEFINITION permission denied (229) (SQLExecDirectW)"
+    )
+    cursor = FailingDmvCursor(table_rows(1, "Orders", "Id"), error)
+
+    with pytest.raises(pyodbc.ProgrammingError):
+        collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=0)
+    assert cursor.sources == ["dmv"]
+
+
+def test_collect_dependencies_ignores_parenthesised_numbers_outside_the_native_error_marker():
+    error = pyodbc.ProgrammingError(
+        "42000", "[42000] [Microsoft][ODBC Driver 18 for SQL Server][SQL Server]"
+                 "The SELECT permission was denied on the object 'Orders(208)'. (229) (SQLExecDirectW)"
+    )
+    cursor = FailingDmvCursor(table_rows(1, "Orders", "Id"), error)
+
+    with pytest.raises(pyodbc.ProgrammingError):
+        collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=0)
+    assert cursor.sources == ["dmv"]
+
+
+def test_referenced_sources_only_return_object_references():
+    cursor = FakeCursor([], {})
+
+    collect_dependencies_via_sys_views(FakeConnection(cursor), "uspMain", depth=0)
+
+    assert "WHERE caller.name = ? AND s.name = ? AND r.referenced_class = 1" in cursor.statements[0]
+    assert "dep.referenced_class = 1" in dependency_resolver._EXPRESSION_DEPENDENCIES_SOURCE
+
+
+class CountingConnection(FakePooledConnection):
+    def __init__(self, cursor):
+        super().__init__(cursor)
+        self.cursors_opened = 0
+
+    def cursor(self):
+        self.cursors_opened += 1
+        return super().cursor()
+
+
+def test_unpooled_lookup_opens_a_single_cursor():
+    conn = CountingConnection(FakeDefinitionCursor("CREATE PROCEDURE uspMain AS SELECT 1"))
+
+    fetch_proc_definition(conn, "uspMain")
+
+    assert conn.cursors_opened == 1
+
+
+def test_resolver_reuses_one_cursor_per_statement_shape():
+    conn = CountingConnection(FakeDefinitionCursor("CREATE PROCEDURE uspMain AS SELECT 1"))
+    resolver = Resolver(conn)
+
+    resolver.proc_definition("uspMain")
+    resolver.proc_definition("uspOther")
+    resolver.proc_definition("uspMain", "dbo", 10)
+
+    assert conn.cursors_opened == 2
+
+
+def test_pool_closes_opened_connections_when_warmup_fails(monkeypatch):
+    opened = []
+    attempts = itertools.count()
+
+    def connect(conn_str):
+        if next(attempts) == 1:
+            raise pyodbc.Error("08001", "[08001] Login timeout expired (0) (SQLDriverConnect)")
+        conn = FakePooledConnection(FakeDefinitionCursor(""))
+        opened.append(conn)
+        return conn
+
+    monkeypatch.setattr(dependency_resolver.pyodbc, "connect", connect)
+    resolvers_before = dict(dependency_resolver._pooled_resolvers)
+
+    with pytest.raises(pyodbc.Error):
+        ConnectionPool(POOL_CONFIG, size=2)
+
+    assert len(opened) == 1 and opened[0].closed
+    assert dependency_resolver._pooled_resolvers == resolvers_before
+
+
+def test_single_connection_pool_connects_without_an_executor(monkeypatch):
+    conn = FakePooledConnection(FakeDefinitionCursor(""))
+    monkeypatch.setattr(dependency_resolver.pyodbc, "connect", lambda conn_str: conn)
+    monkeypatch.setattr(dependency_resolver, "ThreadPoolExecutor", None)
+
+    pool = ConnectionPool(POOL_CONFIG, size=1)
+    try:
+        with pool.connection() as pooled:
+            assert pooled is conn
+    finally:
+        pool.close()
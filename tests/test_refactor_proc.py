@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+import requests
+
+import refactor_proc
+from refactor_proc import log_audit
+
+
+@pytest.fixture(autouse=True)
+def close_audit_fds():
+    yield
+    refactor_proc._close_audit_fds()
+
+
+def read_entries(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_log_audit_appends_one_json_line_per_entry_on_a_cached_fd(tmp_path):
+    path = tmp_path / "run.audit.jsonl"
+
+    log_audit({"proc_name": "uspMain", "response": {"refactored_sql": "SELECT 1"}}, str(path))
+    fd = refactor_proc._audit_fds[str(path)]
+    log_audit({"proc_name": "uspMain", "response": {"refactored_sql": "SELECT 2"}}, str(path))
+
+    assert refactor_proc._audit_fds == {str(path): fd}
+    assert read_entries(path) == [
+        {"proc_name": "uspMain", "response": {"refactored_sql": "SELECT 1"}},
+        {"proc_name": "uspMain", "response": {"refactored_sql": "SELECT 2"}},
+    ]
+
+
+def test_log_audit_appends_to_existing_file(tmp_path):
+    path = tmp_path / "run.audit.jsonl"
+    path.write_text('{"previous": true}\n')
+
+    log_audit({"proc_name": "uspMain"}, str(path))
+
+    assert read_entries(path) == [{"previous": True}, {"proc_name": "uspMain"}]
+
+
+def test_log_audit_falls_back_to_write_without_writev(tmp_path, monkeypatch):
+    monkeypatch.delattr(os, "writev", raising=False)
+    path = tmp_path / "run.audit.jsonl"
+
+    log_audit({"proc_name": "uspMain"}, str(path))
+    log_audit({"proc_name": "uspOther"}, str(path))
+
+    assert read_entries(path) == [{"proc_name": "uspMain"}, {"proc_name": "uspOther"}]
+
+
+def test_close_audit_fds_closes_and_forgets_descriptors(tmp_path):
+    path = tmp_path / "run.audit.jsonl"
+    log_audit({"proc_name": "uspMain"}, str(path))
+    fd = refactor_proc._audit_fds[str(path)]
+
+    refactor_proc._close_audit_fds()
+
+    assert refactor_proc._audit_fds == {}
+    with pytest.raises(OSError):
+        os.fstat(fd)
+
+
+PROC_SQL = "CREATE PROCEDURE dbo.uspMain AS SELECT Id FROM dbo.Orders"
+CONTEXT = {"Orders": {"type": "table", "columns": [
+    {"COLUMN_NAME": "Id", "DATA_TYPE": "int", "CHARACTER_MAXIMUM_LENGTH": None, "IS_NULLABLE": "NO"}
+]}}
+
+
+class FakePool:
+    @contextmanager
+    def connection(self):
+        yield object()
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def cli(tmp_path, monkeypatch):
+    audit_log = tmp_path / "logs" / "uspMain.audit.jsonl"
+    monkeypatch.setattr(sys, "argv", ["refactor_proc.py", "--proc-name", "uspMain", "--audit-log", str(audit_log)])
+    monkeypatch.setattr(refactor_proc, "load_config", lambda path: {
+        "api": {"key": "secret", "endpoint": "https://api.example.com/refactor"},
+        "database": {},
+    })
+    monkeypatch.setattr(refactor_proc, "get_pool", lambda config, size: FakePool())
+    monkeypatch.setattr(refactor_proc, "fetch_proc_definition", lambda conn, name, schema: PROC_SQL)
+    monkeypatch.setattr(refactor_proc, "collect_dependencies_via_sys_views",
+                        lambda conn, name, schema, depth: CONTEXT)
+    return audit_log
+
+
+def test_main_sends_and_audits_the_same_serialized_prompt(cli, monkeypatch, capsys):
+    posts = []
+
+    def post(endpoint, **kwargs):
+        posts.append((endpoint, kwargs))
+        return FakeResponse({"refactored_sql": "  SELECT Id\nFROM dbo.Orders  "})
+
+    monkeypatch.setattr(refactor_proc._session, "post", post)
+
+    refactor_proc.main()
+    refactor_proc._close_audit_fds()
+
+    [(endpoint, kwargs)] = posts
+    assert endpoint == "https://api.example.com/refactor"
+    assert kwargs["headers"]["Authorization"] == "Bearer secret"
+    assert kwargs["timeout"] == refactor_proc._API_TIMEOUT
+    sent_prompt = json.loads(kwargs["data"])
+    assert sent_prompt["proc_name"] == "uspMain"
+    assert sent_prompt["sql"] == PROC_SQL
+    assert sent_prompt["context"] == CONTEXT
+
+    assert kwargs["data"] in cli.read_bytes()
+    [entry] = read_entries(cli)
+    assert entry["prompt"] == sent_prompt
+    assert entry["response"] == {"refactored_sql": "SELECT Id\nFROM dbo.Orders"}
+    assert "Refactoring complete" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("error", [
+    requests.Timeout("read timed out"),
+    requests.ConnectionError("connection refused"),
+])
+def test_main_reports_failed_api_request_without_raising(cli, monkeypatch, capsys, error):
+    def post(endpoint, **kwargs):
+        raise error
+
+    monkeypatch.setattr(refactor_proc._session, "post", post)
+
+    refactor_proc.main()
+
+    assert f"❌ AI API request failed: {error}" in capsys.readouterr().out
+    assert not cli.exists()